@@ -1,186 +1,350 @@
-# Import the PostgreSQL adapter for Python
-import psycopg2
+import contextlib
+import itertools
+import re
+import time
+import uuid
+from operator import itemgetter
+import pandas as pd
+# Import the PostgreSQL adapter for Python (psycopg 3) and its connection pool
+import psycopg
+from psycopg import sql
+from psycopg_pool import ConnectionPool, PoolTimeout
 # Import Streamlit for accessing secrets and displaying messages
 import streamlit as st
 
-def get_db_connection():
-    """Establishes and returns a database connection."""
+STREAM_BATCH_SIZE = 5000  # Rows fetched per round-trip when streaming SELECT results
+POOL_TIMEOUT_SECONDS = 10  # How long to wait for a database connection before giving up
+
+# NOTE: user-supplied SQL is always passed to EXPLAIN as a composed statement,
+# sql.SQL("EXPLAIN ") + sql.SQL(query), never through an f-string, only after
+# _check_explainable() has accepted it, and only inside a pipeline (extended
+# protocol, which refuses to run more than one statement).
+_EXPLAINABLE_KEYWORDS = ("SELECT", "WITH", "VALUES", "TABLE", "INSERT", "UPDATE", "DELETE", "MERGE")
+_LEADING_KEYWORD_RE = re.compile(r"\s*([A-Za-z]+)")
+# Plain string literals (no backslashes, so no E'...' escapes), quoted identifiers and
+# line comments: the only places a ';' may legitimately appear inside one statement
+_QUOTED_OR_COMMENT_RE = re.compile(r"""'(?:[^'\\]|'')*'|"(?:[^"]|"")*"|--[^\n\r]*""")
+# Anything that survives the stripping above and could still hide a statement boundary:
+# unterminated or backslash-escaped quotes, dollar quoting and block comments
+_UNTOKENIZABLE_RE = re.compile(r"""['"\\$]|/\*""")
+
+@st.cache_resource
+def get_connection_pool():
+    """
+    Creates the connection pool once and shares it across Streamlit reruns and sessions,
+    so each helper borrows an open connection instead of running a full connect.
+    """
+    db_config = st.secrets.postgres
+    pool = ConnectionPool(
+        min_size=1,
+        max_size=10,
+        timeout=POOL_TIMEOUT_SECONDS,
+        open=True,
+        kwargs={
+            "host": db_config.host,
+            "port": db_config.port,
+            "user": db_config.user,
+            "password": db_config.password,
+            "dbname": db_config.dbname,
+        },
+    )
+    try:
+        # Fail fast (and don't cache a pool that can't connect) instead of timing out on every call
+        pool.wait(timeout=POOL_TIMEOUT_SECONDS)
+    except PoolTimeout:
+        pool.close()
+        raise
+    return pool
+
+@contextlib.contextmanager
+def borrow_conn():
+    """
+    Borrows a connection from the pool and always hands it back.
+    Yields None if the database cannot be reached.
+    """
     try:
-        db_config = st.secrets.postgres
-        return psycopg2.connect(
-            host=db_config.host,
-            port=db_config.port,
-            user=db_config.user,
-            password=db_config.password,
-            dbname=db_config.dbname
-        )
+        pool = get_connection_pool()
+        conn = pool.getconn()
     except Exception as e:
         st.error(f"Failed to connect to the database: {e}")
-        return None
+        yield None
+        return
+    try:
+        yield conn
+    finally:
+        # Never hand a connection with an open (or aborted) transaction back to the pool
+        try:
+            conn.rollback()
+        except psycopg.Error:
+            pass
+        pool.putconn(conn)
 
-def get_database_schema_string():
+# Catalog lookups are slow and the schema rarely changes, so cache them for an hour.
+# Use clear_schema_cache() to force a re-fetch after a migration.
+@st.cache_data(ttl=3600, show_spinner=False)
+def _list_tables_and_columns():
     """
-    Connects to the PostgreSQL database and dynamically fetches the schema.
-    Formats it into a SIMPLE string (table and column names only) 
-    for the AI model.
+    Reads every public base table and its columns in a single catalog query.
+    Returns a list of (table_name, [column_names]) tuples ordered by table name.
+    Raises psycopg.Error on failure so that errors are never cached.
     """
-    conn = get_db_connection()
-    if not conn:
-        return "Error: Could not connect to the database to fetch schema."
-
-    schema_string = ""
-    try:
+    with borrow_conn() as conn:
+        if not conn:
+            raise psycopg.OperationalError("Could not connect to the database.")
         cursor = conn.cursor()
+        # One round-trip for every table's columns instead of one query per table.
+        # No ORDER BY: sorting a few hundred rows here is cheaper than having the
+        # server sort the output of the information_schema views.
         cursor.execute("""
-            SELECT table_name 
-            FROM information_schema.tables 
-            WHERE table_schema = 'public' AND table_type = 'BASE TABLE'
-            ORDER BY table_name;
+            SELECT c.table_name, c.column_name, c.ordinal_position
+            FROM information_schema.columns AS c
+            JOIN information_schema.tables AS t USING (table_schema, table_name)
+            WHERE t.table_schema = 'public' AND t.table_type = 'BASE TABLE';
         """)
-        tables = cursor.fetchall()
-        for table in tables:
-            table_name = table[0]
-            schema_string += f"Table {table_name}, columns = ["
-            cursor.execute(f"""
-                SELECT column_name
-                FROM information_schema.columns 
-                WHERE table_name = '{table_name}'
-                ORDER BY ordinal_position;
-            """)
-            columns = cursor.fetchall()
-            column_names = [col[0] for col in columns]
-            schema_string += ", ".join(column_names) + "]\n"
+        rows = cursor.fetchall()
+        rows.sort(key=itemgetter(0, 2))
+        tables = [(table_name, [col[1] for col in columns])
+                  for table_name, columns in itertools.groupby(rows, key=itemgetter(0))]
         cursor.close()
-        print("--- Dynamically Fetched Database Schema (Simplified for AI) ---")
-        print(schema_string)
-        print("----------------------------------------------------------------")
-        return schema_string.strip()
-    except psycopg2.Error as db_err:
+        print(f"--- Dynamically Fetched Database Schema: {len(tables)} tables ---")
+        return tables
+
+def get_database_schema_string():
+    """
+    Builds the database schema as a SIMPLE string (table and column names only)
+    for the AI model, from the cached catalog read.
+    """
+    try:
+        tables = _list_tables_and_columns()
+    except psycopg.Error as db_err:
         print(f"Database error while fetching schema: {db_err}")
         return f"Error: Database error while fetching schema: {db_err}"
-    finally:
-        if conn:
-            conn.close()
+
+    parts = [f"Table {table_name}, columns = [{', '.join(column_names)}]\n"
+             for table_name, column_names in tables]
+    return "".join(parts).strip()
+
+def _check_explainable(sql_query: str):
+    """
+    Gate for SQL that gets spliced into EXPLAIN: accepts exactly one statement that
+    starts with a query/DML keyword, so nothing else can ride along behind it.
+    Queries it cannot tokenize reliably (E'...' escapes, dollar quoting, block comments)
+    are rejected rather than guessed at.
+    Returns (query, error_message); the query has its trailing semicolons removed.
+    """
+    query = (sql_query or "").strip().rstrip(";").rstrip()
+    if not query:
+        return None, "Query is empty."
+    keyword = _LEADING_KEYWORD_RE.match(query)
+    if not keyword or keyword.group(1).upper() not in _EXPLAINABLE_KEYWORDS:
+        return None, f"Invalid Query: only {', '.join(_EXPLAINABLE_KEYWORDS)} statements can be validated."
+    code = _QUOTED_OR_COMMENT_RE.sub(" ", query)
+    if _UNTOKENIZABLE_RE.search(code):
+        return None, "Invalid Query: escaped or dollar-quoted strings and block comments cannot be validated."
+    if ";" in code:
+        return None, "Invalid Query: only a single SQL statement can be validated."
+    return query, None
 
 def validate_sql_query(sql_query: str):
     """
     Validates the SQL query syntax using EXPLAIN without executing it.
     Returns (is_valid, message).
     """
-    if not sql_query or not sql_query.strip():
-        return False, "Query is empty."
+    return validate_sql_queries([sql_query])[0]
 
-    conn = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(f"EXPLAIN {sql_query}")
-        cursor.close()
-        return True, "Query syntax is valid."
-    except psycopg2.Error as db_err:
-        error_message = f"Invalid Query: {str(db_err).splitlines()[0]}"
-        return False, error_message
-    finally:
-        if conn:
-            conn.close()
+def validate_sql_queries(sql_queries: list, execute_first_valid: bool = False, before_execute=None):
+    """
+    Validates several SQL queries with EXPLAIN on a single pooled connection.
+    The EXPLAINs are pipelined, so when every query is valid they all go out in
+    one round-trip; each invalid query costs one extra round-trip.
+    Returns a list of (is_valid, message) tuples in the same order as the input.
+
+    With execute_first_valid=True the first valid query (in input order) is also run
+    on the same connection, right after its EXPLAIN, and the return value becomes
+    (validations, execution): execution is (query, results, error_message, seconds)
+    like execute_pg_query plus the execution time, or None if no query was valid.
+    before_execute, if given, is called with that query just before it runs.
+    """
+    checked = [_check_explainable(sql_query) for sql_query in sql_queries]
+    results = [(False, error) if error else None for _, error in checked]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if not pending:
+        return (results, None) if execute_first_valid else results
+
+    with borrow_conn() as conn:
+        if not conn:
+            results = [result or (False, "Could not connect to the database to validate the query.")
+                       for result in results]
+            return (results, None) if execute_first_valid else results
+        try:
+            while pending:
+                # The server skips everything after the first failure in a pipeline, so
+                # record that failure and send the queries after it again in the next round.
+                cursors = []
+                first_error = None
+                try:
+                    with conn.pipeline():
+                        for i in pending:
+                            cursor = conn.cursor()
+                            cursors.append(cursor)
+                            cursor.execute(sql.SQL("EXPLAIN ") + sql.SQL(checked[i][0]))
+                except psycopg.Error as db_err:
+                    first_error = db_err
+                valid_count = 0
+                for cursor in cursors:
+                    if cursor.description is None:
+                        break
+                    valid_count += 1
+                for i in pending[:valid_count]:
+                    results[i] = (True, "Query syntax is valid.")
+                if first_error is None:
+                    break
+                conn.rollback()
+                results[pending[valid_count]] = (False, f"Invalid Query: {str(first_error).splitlines()[0]}")
+                pending = pending[valid_count + 1:]
+        except psycopg.Error as db_err:
+            # The connection itself failed; report it for every query not yet checked
+            error_message = f"Invalid Query: {str(db_err).splitlines()[0]}"
+            results = [result or (False, error_message) for result in results]
+        if not execute_first_valid:
+            return results
+
+        first_valid = next((i for i, (is_valid, _) in enumerate(results) if is_valid), None)
+        if first_valid is None:
+            return results, None
+        query = checked[first_valid][0]
+        if before_execute is not None:
+            before_execute(query)
+        # The query runs on the connection that just planned it, without another pool checkout
+        start_time = time.perf_counter()
+        try:
+            conn.rollback()  # End the validation transaction first
+            query_results, error_message = _run_query(conn, query), None
+        except psycopg.Error as db_err:
+            query_results, error_message = None, f"Database Execution Error: {str(db_err).splitlines()[0]}"
+        return results, (query, query_results, error_message, time.perf_counter() - start_time)
+
+def _unique_column_names(names: list) -> list:
+    """
+    Suffixes repeated column names (name, name_1, name_2, ...) so the DataFrame can be
+    displayed; joins such as SELECT * FROM a JOIN b USING ... often repeat a key column.
+    """
+    used = set(names)
+    seen = set()
+    unique_names = []
+    for name in names:
+        if name in seen:
+            suffix = 1
+            while f"{name}_{suffix}" in used:
+                suffix += 1
+            name = f"{name}_{suffix}"
+            used.add(name)
+        seen.add(name)
+        unique_names.append(name)
+    return unique_names
+
+def _run_query(conn, sql_query: str):
+    """
+    Runs a query on an already borrowed connection.
+    Returns a pandas DataFrame for statements that produce rows (SELECT, WITH, SHOW,
+    ... RETURNING) or a success message string; raises psycopg.Error.
+    """
+    if sql_query.lstrip()[:6].upper() == "SELECT":
+        # A named (server-side) cursor streams rows in batches straight into the
+        # DataFrame instead of buffering the whole result set on the client first
+        with conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+            cursor.itersize = STREAM_BATCH_SIZE
+            cursor.execute(sql_query)
+            colnames = _unique_column_names([desc.name for desc in cursor.description])
+            return pd.DataFrame.from_records(iter(cursor), columns=colnames)
+    cursor = conn.cursor()
+    cursor.execute(sql_query)
+    # Postgres reports whether the statement returned a result set, which covers the
+    # row-returning statements that don't start with SELECT
+    if cursor.description is not None:
+        colnames = _unique_column_names([desc.name for desc in cursor.description])
+        results = pd.DataFrame.from_records(cursor.fetchall(), columns=colnames)
+    else:
+        results = f"Query executed successfully. Rows affected: {cursor.rowcount}"
+    conn.commit()
+    cursor.close()
+    return results
 
 def execute_pg_query(sql_query: str):
     """
     Executes a SQL query against the PostgreSQL database configured in Streamlit secrets.
     Returns a tuple: (results, error_message).
-    'results' can be a list of dictionaries (for SELECT) or a success message string.
+    'results' can be a pandas DataFrame (for SELECT) or a success message string.
     'error_message' is a string if an error occurs, otherwise None.
     """
-    conn = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(sql_query)
-        results = None
-        if sql_query.strip().upper().startswith("SELECT"):
-            if cursor.description:
-                colnames = [desc[0] for desc in cursor.description]
-                results = [dict(zip(colnames, row)) for row in cursor.fetchall()]
-            else:
-                results = []
-        else:
-            conn.commit()
-            results = f"Query executed successfully. Rows affected: {cursor.rowcount}"
-        cursor.close()
-        return results, None
-    except psycopg2.Error as db_err:
-        error_message = f"Database Execution Error: {str(db_err).splitlines()[0]}"
-        return None, error_message
-    finally:
-        if conn:
-            conn.close()
+    with borrow_conn() as conn:
+        if not conn:
+            return None, "Database Execution Error: Could not connect to the database."
+        try:
+            return _run_query(conn, sql_query), None
+        except psycopg.Error as db_err:
+            error_message = f"Database Execution Error: {str(db_err).splitlines()[0]}"
+            return None, error_message
 
 def list_tables():
     """
     Returns a list of all table names in the public schema.
     """
-    conn = None
     try:
-        db_config = {
-            'host': st.secrets.postgres.host,
-            'port': st.secrets.postgres.port,
-            'user': st.secrets.postgres.user,
-            'password': st.secrets.postgres.password,
-            'dbname': st.secrets.postgres.dbname
-        }
-        conn = psycopg2.connect(**db_config)
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT table_name
-            FROM information_schema.tables
-            WHERE table_schema = 'public'
-              AND table_type = 'BASE TABLE';
-        """)
-        tables = [row[0] for row in cursor.fetchall()]
-        cursor.close()
-        return tables
+        return [table_name for table_name, _ in _list_tables_and_columns()]
     except Exception as e:
         print(f"Error listing tables: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
-def get_foreign_key_relationships():
+@st.cache_data(ttl=3600, show_spinner=False)
+def _list_foreign_keys():
     """
-    Connects to the DB and fetches foreign key relationships.
-    Returns a list of strings describing the relationships.
+    Reads every foreign key column pair from pg_catalog.
+    Returns a list of (table, column, foreign_table, foreign_column) tuples.
+    Raises psycopg.Error on failure so that errors are never cached.
     """
-    conn = get_db_connection()
-    if not conn:
-        return ["Error: Could not connect to DB for FKs."]
-    relationships = []
-    try:
+    with borrow_conn() as conn:
+        if not conn:
+            raise psycopg.OperationalError("Could not connect to the database.")
         cursor = conn.cursor()
+        # Read pg_catalog directly: the information_schema views wrap these same
+        # catalogs but are far slower to plan. unnest() pairs each column of a
+        # multi-column key with its matching referenced column.
         query = """
         SELECT
-            tc.table_name, 
-            kcu.column_name, 
-            ccu.table_name AS foreign_table_name,
-            ccu.column_name AS foreign_column_name 
-        FROM 
-            information_schema.table_constraints AS tc 
-            JOIN information_schema.key_column_usage AS kcu
-              ON tc.constraint_name = kcu.constraint_name
-              AND tc.table_schema = kcu.table_schema
-            JOIN information_schema.constraint_column_usage AS ccu
-              ON ccu.constraint_name = tc.constraint_name
-              AND ccu.table_schema = tc.table_schema
-        WHERE tc.constraint_type = 'FOREIGN KEY';
+            cl.relname AS table_name,
+            a.attname AS column_name,
+            fcl.relname AS foreign_table_name,
+            fa.attname AS foreign_column_name
+        FROM
+            pg_catalog.pg_constraint AS c
+            CROSS JOIN LATERAL unnest(c.conkey, c.confkey) AS k(attnum, foreign_attnum)
+            JOIN pg_catalog.pg_class AS cl ON cl.oid = c.conrelid
+            JOIN pg_catalog.pg_class AS fcl ON fcl.oid = c.confrelid
+            JOIN pg_catalog.pg_attribute AS a
+              ON a.attrelid = c.conrelid AND a.attnum = k.attnum
+            JOIN pg_catalog.pg_attribute AS fa
+              ON fa.attrelid = c.confrelid AND fa.attnum = k.foreign_attnum
+        WHERE c.contype = 'f';
         """
         cursor.execute(query)
-        for row in cursor.fetchall():
-            table_name, column_name, foreign_table_name, foreign_column_name = row
-            relationships.append(f"{table_name}.{column_name} can be joined with {foreign_table_name}.{foreign_column_name}")
+        relationships = [tuple(row) for row in cursor.fetchall()]
         cursor.close()
         return relationships
-    except psycopg2.Error as db_err:
-        return [f"DB Error fetching FKs: {db_err}"]
-    finally:
-        if conn:
-            conn.close() 
\ No newline at end of file
+
+def get_foreign_key_relationships():
+    """
+    Fetches the foreign key relationships from the cached catalog read.
+    Returns a list of (table, column, foreign_table, foreign_column) tuples,
+    or an empty list if they could not be fetched.
+    """
+    try:
+        return _list_foreign_keys()
+    except psycopg.Error as db_err:
+        print(f"DB Error fetching FKs: {db_err}")
+        return []
+
+def clear_schema_cache():
+    """Drops the cached schema and foreign key lookups so the next call re-reads the catalog."""
+    _list_tables_and_columns.clear()
+    _list_foreign_keys.clear()
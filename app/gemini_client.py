@@ -0,0 +1,56 @@
+import streamlit as st
+import google.generativeai as genai
+import asyncio
+import threading
+
+# --- The one Gemini model every call goes through ---
+GEMINI_MODEL = 'models/gemini-1.5-pro-latest'
+
+# Created on first use. The lock makes sure concurrent Streamlit sessions
+# never start a second loop or model (lru_cache doesn't serialise first calls).
+_loop = None
+_model = None
+_init_lock = threading.Lock()
+
+
+def _event_loop():
+    """
+    Starts one long-lived event loop in a background thread for all Gemini calls.
+    The async Gemini client binds its channel to the loop that first uses it, so calls
+    must not each spin up their own loop with asyncio.run().
+    """
+    global _loop
+    if _loop is None:
+        with _init_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="gemini-event-loop", daemon=True).start()
+                _loop = loop
+    return _loop
+
+def get_model():
+    """
+    Configures the API key once and builds the Gemini model shared by every call.
+    Together with the single event loop this keeps one gRPC channel (a persistent
+    HTTP/2 connection) open, so only the first call pays for the TCP and TLS handshakes.
+    Raises AttributeError/KeyError if the API key is missing from secrets.toml.
+    """
+    global _model
+    if _model is None:
+        with _init_lock:
+            if _model is None:
+                genai.configure(api_key=st.secrets.google_ai.api_key)
+                _model = genai.GenerativeModel(GEMINI_MODEL)
+    return _model
+
+def run_in_background(coro):
+    """
+    Schedules a coroutine on the shared Gemini event loop without waiting for it.
+    Returns a concurrent.futures.Future; call .result() once the answer is needed,
+    so the Gemini round-trip overlaps whatever the caller does in between.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop())
+
+def run_sync(coro):
+    """Runs a coroutine on the shared Gemini event loop and blocks until it finishes."""
+    return run_in_background(coro).result()
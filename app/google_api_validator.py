@@ -1,54 +1,158 @@
 import streamlit as st
-import google.generativeai as genai
+from google.api_core import exceptions as gexc
+import asyncio
+import functools
+import hashlib
 import json
+import os
+import threading
 import time
-import re
+from gemini_client import GEMINI_MODEL, get_model, run_sync
+
+# Optional: orjson parses the (sometimes large) JSON answers several times faster than json
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Optional: on-disk cache of Gemini responses, so re-grading the same answer is instant and free
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
 
 # --- Constants for the retry logic ---
 MAX_RETRIES = 5
 INITIAL_WAIT_SECONDS = 2
-FORCED_WAIT_SECONDS = 20  # Always wait 20 seconds between queries as requested
+# --- Constants for the response cache ---
+RESPONSE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.llmcache')
+RESPONSE_CACHE_TTL_SECONDS = 86400  # Cached grades expire after a day
+# --- Constants for request pacing ---
+MAX_CONCURRENT_REQUESTS = 5  # Upper bound on in-flight Gemini calls when grading many answers
+REQUESTS_PER_MINUTE = 3      # Sustained rate per API key (one call every 20 seconds on average)
+BURST_SIZE = 5               # Calls per API key that may go out back-to-back before pacing kicks in
+
+
+class _TokenBucket:
+    """
+    Paces calls made with one API key: allows a short burst, then one call per refill interval.
+    Thread-safe, and never sleeps while holding its lock.
+    """
+    def __init__(self, rate_per_second: float, capacity: int):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how many seconds the caller must wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+            self.updated_at = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate_per_second
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def _bucket_for(api_key: str) -> _TokenBucket:
+    with _buckets_lock:
+        if api_key not in _buckets:
+            _buckets[api_key] = _TokenBucket(REQUESTS_PER_MINUTE / 60, BURST_SIZE)
+        return _buckets[api_key]
+
+
+@functools.lru_cache(maxsize=1)
+def _response_cache():
+    """Opens the on-disk response cache, or returns None if diskcache is not installed."""
+    if diskcache is None:
+        return None
+    return diskcache.Cache(RESPONSE_CACHE_DIR)
+
+def _cache_key(prompt_parts: list) -> str:
+    """Hashes the model name and every prompt part into a cache key."""
+    digest = hashlib.sha256(GEMINI_MODEL.encode())
+    for part in prompt_parts:
+        digest.update(b"\0" + part.encode())
+    return digest.hexdigest()
+
 
-def _call_gemini_with_retry(prompt_text: str):
+def _suggested_retry_delay(error: gexc.GoogleAPICallError):
+    """Returns the retry delay (in seconds) the API attached to a rate limit error, or None."""
+    for detail in error.details or ():
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds
+    return None
+
+async def _call_gemini_with_retry(prompt_parts: list):
     """
-    A private helper function that calls the Gemini API with exponential backoff and a forced wait.
+    A private helper coroutine that calls the Gemini API with exponential backoff.
+    Calls are paced per API key by a token bucket, so concurrent requests can overlap
+    without tripping the rate limit.
+    `prompt_parts` is [static_prefix, task]: the prefix is byte-identical across calls
+    so Gemini can serve it from its implicit prompt cache.
     """
+    cache = _response_cache()
+    cache_key = _cache_key(prompt_parts)
+    if cache is not None:
+        cached_result = cache.get(cache_key)
+        if cached_result is not None:
+            print("Gemini response served from the local cache.")
+            return cached_result
+    try:
+        model = get_model()
+    except (AttributeError, KeyError):
+        return {"error": "Google API key not found in secrets.toml."}
+    bucket = _bucket_for(st.secrets.google_ai.api_key)
     for i in range(MAX_RETRIES):
         try:
-            model = genai.GenerativeModel('models/gemini-1.5-pro-latest')
-            response = model.generate_content(prompt_text)
-            # Success! Clean and return the JSON.
-            json_text = response.text.strip().replace("```json", "").replace("```", "")
-            try:
-                return json.loads(json_text)
-            except Exception as e:
-                print("Gemini raw response:", json_text)
-                return {"error": f"Gemini returned invalid JSON. Raw response: {json_text[:500]}... Error: {e}"}
-            # Always wait 20 seconds after a successful call
-            time.sleep(FORCED_WAIT_SECONDS)
-            return json.loads(json_text)
-        except Exception as e:
-            error_str = str(e)
-            # Check if it's a rate limit error (429)
-            if "429" in error_str:
-                print(f"API rate limit hit. Attempt {i + 1} of {MAX_RETRIES}.")
-                # Check if the API suggests a specific retry delay
-                match = re.search(r"retry_delay {\s*seconds: (\d+)\s*}", error_str)
-                if match:
-                    wait_time = int(match.group(1)) + 1 # Add 1 second buffer
-                    print(f"API suggested waiting {wait_time} seconds.")
-                else:
-                    # If no suggestion, use exponential backoff
-                    wait_time = INITIAL_WAIT_SECONDS * (2 ** i)
-                    print(f"No specific delay suggested. Waiting for {wait_time} seconds.")
-                # If this is the last attempt, don't wait, just fail.
-                if i < MAX_RETRIES - 1:
-                    time.sleep(wait_time)
-                continue # Go to the next iteration of the loop
+            wait_time = bucket.reserve()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            # Stream the response so chunks are read off the wire as they arrive
+            # instead of waiting for the whole multi-KB JSON body in one go
+            response = await model.generate_content_async(prompt_parts, stream=True)
+            json_text = "".join([chunk.text async for chunk in response])
+            usage = response.usage_metadata
+            print(f"Gemini prompt tokens: {usage.prompt_token_count}, "
+                  f"served from cache: {getattr(usage, 'cached_content_token_count', 0)}")
+        except gexc.TooManyRequests as e:
+            # Rate limit error (429); ResourceExhausted is a subclass
+            print(f"API rate limit hit. Attempt {i + 1} of {MAX_RETRIES}.")
+            # Check if the API suggests a specific retry delay
+            retry_delay = _suggested_retry_delay(e)
+            if retry_delay:
+                wait_time = retry_delay + 1 # Add 1 second buffer
+                print(f"API suggested waiting {wait_time} seconds.")
             else:
-                # If it's a different error (e.g., 404, 500), fail immediately.
-                print(f"A non-retryable API error occurred: {e}")
-                return {"error": f"A non-retryable API error occurred: {e}"}
+                # If no suggestion, use exponential backoff
+                wait_time = INITIAL_WAIT_SECONDS * (2 ** i)
+                print(f"No specific delay suggested. Waiting for {wait_time} seconds.")
+            # If this is the last attempt, don't wait, just fail.
+            if i < MAX_RETRIES - 1:
+                await asyncio.sleep(wait_time)
+            continue # Go to the next iteration of the loop
+        except Exception as e:
+            # If it's a different error (e.g., 404, 500), fail immediately.
+            print(f"A non-retryable API error occurred: {e}")
+            return {"error": f"A non-retryable API error occurred: {e}"}
+        # Success! Pull the JSON object out of the response and return it.
+        # Keep only the outermost JSON object, ignoring ``` fences or stray prose around it
+        start, end = json_text.find("{"), json_text.rfind("}")
+        try:
+            result = _json_loads(json_text[start:end + 1] if 0 <= start < end else json_text)
+        except Exception as e:
+            print("Gemini raw response:", json_text)
+            return {"error": f"Gemini returned invalid JSON. Raw response: {json_text[:500]}... Error: {e}"}
+        # Only successful answers are cached; errors are always retried on the next call
+        if cache is not None:
+            cache.set(cache_key, result, expire=RESPONSE_CACHE_TTL_SECONDS)
+        return result
     # If the loop finishes without a successful return, it means all retries failed.
     return {"error": f"Failed to get a response from the API after {MAX_RETRIES} attempts due to persistent rate limiting."}
 
@@ -56,24 +160,43 @@ def _call_gemini_with_retry(prompt_text: str):
 def grade_student_sql_with_google_api(db_schema: str, fk_relationships: str, user_question: str, expert_sql: str, student_sql: str):
     """
     Uses Google's Gemini API to grade a student's SQL query.
-    Now uses the robust retry mechanism.
+    Blocking wrapper around grade_student_sql_async.
     """
-    try:
-        genai.configure(api_key=st.secrets.google_ai.api_key)
-    except (AttributeError, KeyError):
-        return {"error": "Google API key not found in secrets.toml."}
+    return run_sync(grade_student_sql_async(db_schema, fk_relationships, user_question, expert_sql, student_sql))
+
 
-    grading_prompt = f"""
+@functools.lru_cache(maxsize=8)
+def _grading_prefix(db_schema: str, fk_relationships: str) -> str:
+    """The static part of the grading prompt: instructions, response format, schema and FKs."""
+    return f"""
     You are an expert PostgreSQL Teaching Assistant. Your task is to grade a student's SQL query.
     You will be given the database schema, the original question, a correct "expert" SQL query, and the student's submitted SQL query.
 
+    **Your Grading Task:**
+    Compare the student's query to the expert's query. The student's query does not need to be identical, but it MUST be **semantically equivalent** (i.e., it must produce the exact same result set).
+    Respond ONLY with a valid JSON object in the following format. Do not add any text before or after the JSON object.
+
+    {{
+      "is_semantically_correct": <true if the student's query produces the same result as the expert's, otherwise false>,
+      "score": <An integer score from 1 to 10. 10 for a perfect, semantically correct answer. 5-9 for a query that is close but has minor errors. 1-4 for a query that is fundamentally wrong.>,
+      "feedback": "<A brief, helpful, one-sentence feedback for the student. Explain what they did right or what their primary mistake was. For example: 'Great use of JOIN! However, your WHERE clause is missing a condition.' or 'Perfect! This is an excellent and correct query.'>"
+    }}
+
     **Evaluation Context:**
     1.  **Database Schema:**
         {db_schema}
 
     2.  **Foreign Key Relationships (for JOINs):**
         {fk_relationships}
+    """
+
 
+async def grade_student_sql_async(db_schema: str, fk_relationships: str, user_question: str, expert_sql: str, student_sql: str):
+    """
+    Uses Google's Gemini API to grade a student's SQL query.
+    Now uses the robust retry mechanism.
+    """
+    task = f"""
     3.  **The Original Question:**
         "{user_question}"
 
@@ -86,41 +209,71 @@ def grade_student_sql_with_google_api(db_schema: str, fk_relationships: str, use
         ```sql
         {student_sql}
         ```
+    """
+    return await _call_gemini_with_retry([_grading_prefix(db_schema, fk_relationships), task])
 
-    **Your Grading Task:**
-    Compare the student's query to the expert's query. The student's query does not need to be identical, but it MUST be **semantically equivalent** (i.e., it must produce the exact same result set).
-    Respond ONLY with a valid JSON object in the following format. Do not add any text before or after the JSON object.
 
-    {{
-      "is_semantically_correct": <true if the student's query produces the same result as the expert's, otherwise false>,
-      "score": <An integer score from 1 to 10. 10 for a perfect, semantically correct answer. 5-9 for a query that is close but has minor errors. 1-4 for a query that is fundamentally wrong.>,
-      "feedback": "<A brief, helpful, one-sentence feedback for the student. Explain what they did right or what their primary mistake was. For example: 'Great use of JOIN! However, your WHERE clause is missing a condition.' or 'Perfect! This is an excellent and correct query.'>"
-    }}
+async def grade_many_async(items: list, concurrency: int = MAX_CONCURRENT_REQUESTS):
     """
-    return _call_gemini_with_retry(grading_prompt)
+    Grades several student answers concurrently, with at most `concurrency` calls in flight.
+    Each item is a dict of keyword arguments for grade_student_sql_async.
+    Returns the grading results in the same order as the items.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _grade_one(item):
+        async with semaphore:
+            return await grade_student_sql_async(**item)
+
+    return list(await asyncio.gather(*[_grade_one(item) for item in items]))
+
+
+def grade_many(items: list, concurrency: int = MAX_CONCURRENT_REQUESTS):
+    """Blocking wrapper around grade_many_async."""
+    return run_sync(grade_many_async(items, concurrency))
 
 
 def validate_and_score_sql_with_google_api(db_schema: str, fk_relationships: str, user_question: str, generated_sql: str):
     """
     Uses Google's Gemini API to validate a single SQL query.
-    Now uses the robust retry mechanism.
+    Blocking wrapper around validate_and_score_sql_async.
     """
-    try:
-        genai.configure(api_key=st.secrets.google_ai.api_key)
-    except (AttributeError, KeyError):
-        return {"error": "Google API key not found in secrets.toml."}
+    return run_sync(validate_and_score_sql_async(db_schema, fk_relationships, user_question, generated_sql))
+
 
-    validation_prompt = f"""
+@functools.lru_cache(maxsize=8)
+def _validation_prefix(db_schema: str, fk_relationships: str) -> str:
+    """The static part of the validation prompt: instructions, response format, schema and FKs."""
+    return f"""
     You are an expert PostgreSQL data analyst. Your task is to validate a SQL query generated from a natural language question.
     You will be given the database schema, the original question, and the generated SQL query.
 
+    **Your Validation Task:**
+    Determine if the generated SQL query is correct for the question and schema. Respond ONLY with a valid JSON object in the following format. Do not add any text before or after the JSON object.
+
+    {{
+      "is_correct": <true if the query is correct, otherwise false>,
+      "confidence": "<High, Medium, or Low>",
+      "score": <an integer score from 1 to 10>,
+      "explanation": "<A brief, one-sentence explanation of your reasoning.>",
+      "corrected_sql": "<The corrected version of the SQL query.>"
+    }}
+
     **Evaluation Context:**
     1.  **Database Schema:**
         {db_schema}
 
     2.  **Foreign Key Relationships (for JOINs):**
         {fk_relationships}
+    """
+
 
+async def validate_and_score_sql_async(db_schema: str, fk_relationships: str, user_question: str, generated_sql: str):
+    """
+    Uses Google's Gemini API to validate a single SQL query.
+    Now uses the robust retry mechanism.
+    """
+    task = f"""
     3.  **The Original Question:**
         "{user_question}"
 
@@ -128,31 +281,10 @@ def validate_and_score_sql_with_google_api(db_schema: str, fk_relationships: str
         ```sql
         {generated_sql}
         ```
-
-    **Your Validation Task:**
-    Determine if the generated SQL query is correct for the question and schema. Respond ONLY with a valid JSON object in the following format. Do not add any text before or after the JSON object.
-
-    {{
-      "is_correct": <true if the query is correct, otherwise false>,
-      "confidence": "<High, Medium, or Low>",
-      "score": <an integer score from 1 to 10>,
-      "explanation": "<A brief, one-sentence explanation of your reasoning.>",
-      "corrected_sql": "<The corrected version of the SQL query.>"
-    }}
     """
-    return _call_gemini_with_retry(validation_prompt)
+    return await _call_gemini_with_retry([_validation_prefix(db_schema, fk_relationships), task])
 
-def gemini_grade_full_lab_sheet(full_pdf_text: str):
-    """
-    Uses Gemini to process the entire PDF lab sheet, extract questions and answers, and grade each answer.
-    Returns a dictionary with a 'questions' list, each containing question, student_answer, score, correctness, and feedback.
-    """
-    try:
-        genai.configure(api_key=st.secrets.google_ai.api_key)
-    except (AttributeError, KeyError):
-        return {"error": "Google API key not found in secrets.toml."}
-
-    grading_prompt = f"""
+FULL_SHEET_GRADING_INSTRUCTIONS = """
 You are an expert SQL instructor. You will be given the full text of a student's lab sheet, which contains both the questions and the student's SQL answers. Your job is to:
 
 1. Identify each individual question and its corresponding student answer.
@@ -165,45 +297,25 @@ You are an expert SQL instructor. You will be given the full text of a student's
 
 Respond ONLY with a valid JSON object in the following format. Do not add any text before or after the JSON object.
 
-{{
+{
   "questions": [
-    {{
+    {
       "question": "<The question text>",
       "student_answer": "<The student's SQL answer>",
       "score": <integer 0-10>,
       "correctness": "correct|incorrect|partial",
       "feedback": "<A brief, clear explanation for the student>"
-    }},
+    },
     ...
   ]
-}}
+}
 
 Here is the full lab sheet text:
 """
-    grading_prompt += full_pdf_text
 
-    for i in range(MAX_RETRIES):
-        try:
-            model = genai.GenerativeModel('models/gemini-1.5-pro-latest')
-            response = model.generate_content(grading_prompt)
-            json_text = response.text.strip().replace("```json", "").replace("```", "")
-            try:
-                return json.loads(json_text)
-            except Exception as e:
-                print("Gemini raw response:", json_text)
-                return {"error": f"Gemini returned invalid JSON. Raw response: {json_text[:500]}... Error: {e}"}
-            time.sleep(FORCED_WAIT_SECONDS)
-        except Exception as e:
-            error_str = str(e)
-            if "429" in error_str:
-                match = re.search(r"retry_delay {\s*seconds: (\d+)\s*}", error_str)
-                if match:
-                    wait_time = int(match.group(1)) + 1
-                else:
-                    wait_time = INITIAL_WAIT_SECONDS * (2 ** i)
-                if i < MAX_RETRIES - 1:
-                    time.sleep(wait_time)
-                continue
-            else:
-                return {"error": f"A non-retryable API error occurred: {e}"}
-    return {"error": f"Failed to get a response from the API after {MAX_RETRIES} attempts due to persistent rate limiting."} 
\ No newline at end of file
+def gemini_grade_full_lab_sheet(full_pdf_text: str):
+    """
+    Uses Gemini to process the entire PDF lab sheet, extract questions and answers, and grade each answer.
+    Returns a dictionary with a 'questions' list, each containing question, student_answer, score, correctness, and feedback.
+    """
+    return run_sync(_call_gemini_with_retry([FULL_SHEET_GRADING_INSTRUCTIONS, full_pdf_text]))
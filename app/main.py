@@ -3,18 +3,21 @@ import os
 import streamlit as st
 import pandas as pd
 import graphviz  # For visualizing the database schema
-from pdf_extractor import extract_sql_from_pdf
-from google_api_validator import grade_student_sql_with_google_api, validate_and_score_sql_with_google_api
-# You may need to adjust these imports based on your actual model/database module names
-from model import generate_multiple_sql
-from database import get_database_schema_string, get_foreign_key_relationships, validate_sql_query, execute_pg_query
-import time  # Add this at the top of the file
 
-# Add the project root directory to sys.path
+# Add the project root directory to sys.path (before importing the project's packages)
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
+from pdf_extractor import extract_sql_from_pdf
+from google_api_validator import grade_student_sql_with_google_api, validate_and_score_sql_async, grade_many
+from gemini_client import run_in_background
+# You may need to adjust these imports based on your actual model/database module names
+from model import generate_multiple_sql, generate_multiple_sql_batch
+from database import get_database_schema_string, get_foreign_key_relationships, validate_sql_queries, clear_schema_cache
+from chatbot.bot import chatbot_response, app_help_response
+import time  # Add this at the top of the file
+
 # Optional: Spell correction
 try:
     from spellchecker import SpellChecker
@@ -33,24 +36,18 @@ def clean_select_clause(sql_query: str) -> str:
     Removes duplicate columns from a SQL SELECT statement while preserving order.
     Example: "SELECT a, b, a FROM t" becomes "SELECT a, b FROM t"
     """
-    if not sql_query.upper().strip().startswith("SELECT"):
+    upper_query = sql_query.upper()
+    if not upper_query.lstrip().startswith("SELECT"):
         return sql_query
-    from_position = sql_query.upper().find(" FROM ")
+    from_position = upper_query.find(" FROM ")
     if from_position == -1:
         return sql_query
-    select_part = sql_query[:from_position]
-    from_part = sql_query[from_position:]
-    columns_str = select_part[len("SELECT "):].strip()
-    columns = [col.strip() for col in columns_str.split(',')]
-    unique_columns = []
-    seen_columns = set()
-    for col in columns:
-        if col not in seen_columns:
-            unique_columns.append(col)
-            seen_columns.add(col)
-    cleaned_select_part = "SELECT " + ", ".join(unique_columns)
-    final_query = cleaned_select_part + from_part
-    return final_query
+    columns = [col.strip() for col in sql_query[len("SELECT "):from_position].split(',')]
+    # dict.fromkeys keeps the first occurrence of each column, in order
+    unique_columns = list(dict.fromkeys(columns))
+    if len(unique_columns) == len(columns):
+        return sql_query
+    return "SELECT " + ", ".join(unique_columns) + sql_query[from_position:]
 
 # --- The 20 Ground Truth Questions ---
 GROUND_TRUTH_QUESTIONS = [
@@ -73,9 +70,8 @@ GROUND_TRUTH_QUESTIONS = [
 
 st.set_page_config(layout="wide", page_title="SQL Grader & Validator")
 
-# --- Caching Data ---
-# Cache the schema and FK relationships so they are only fetched once per session
-@st.cache_data
+# --- Loading Data ---
+# The schema and FK lookups are cached in the database module (see clear_schema_cache)
 def load_db_info():
     schema = get_database_schema_string()
     fk_rels = get_foreign_key_relationships()
@@ -83,14 +79,119 @@ def load_db_info():
 
 db_schema, fk_relationships = load_db_info()
 
-# The get_foreign_key_relationships() function should return a list of strings.
+# get_foreign_key_relationships() returns (table, column, foreign_table, foreign_column) tuples.
 # We will format this list into a single multi-line string for the prompt.
-if isinstance(fk_relationships, list) and fk_relationships:
-    fk_relationships_str = "\n".join([f"-- {rel}" for rel in fk_relationships])
+if fk_relationships:
+    fk_relationships_str = "\n".join([f"-- {t1}.{c1} can be joined with {t2}.{c2}"
+                                      for t1, c1, t2, c2 in fk_relationships])
 else:
     # This is a fallback in case the function returns an error or an empty list
     fk_relationships_str = "-- No foreign key relationships were found or an error occurred."
 
+@st.cache_data(show_spinner=False)
+def _prompt_prefix(schema: str, fk_relationships: str) -> str:
+    """
+    Builds the static part of the SQL generation prompt (instructions, schema, foreign keys
+    and few-shot examples) once per schema; callers only append the new question.
+    """
+    return f"""-- You are a PostgreSQL expert. Given a database schema and a question, generate a correct PostgreSQL query.
+-- Use table aliases for clarity. Pay close attention to the Foreign Key Relationships to construct JOINs.
+
+-- Database Schema:
+{schema}
+
+-- Foreign Key Relationships (How to JOIN tables):
+{fk_relationships}
+
+-- Example 1 (Teaches a simple, single-table query):
+### Question: Show the name and country of all suppliers.
+### SQL: SELECT supplier_name, country FROM suppliers
+
+-- Example 2 (Teaches JOIN and GROUP BY):
+### Question: How many products are in each category? Show the category name.
+### SQL: SELECT T2.category_name, count(T1.product_id) FROM products AS T1 JOIN categories AS T2 ON T1.category_id = T2.category_id GROUP BY T2.category_name
+
+-- Example 3 (Teaches NOT IN Subquery):
+### Question: Find all customers who have not placed an order.
+### SQL: SELECT T1.first_name, T1.last_name FROM customers AS T1 WHERE T1.customer_id NOT IN (SELECT T2.customer_id FROM orders AS T2)
+
+-- Example 4 (Teaches Subquery on a SINGLE TABLE):
+### Question: List all employees who earn more than the average salary.
+### SQL: SELECT T1.first_name, T1.salary FROM employees AS T1 WHERE T1.salary > (SELECT avg(T2.salary) FROM employees AS T2)
+
+-- Example 5 (Teaches MIN/MAX Aggregate Functions):
+### Question: What is the lowest and highest price of a product?
+### SQL: SELECT MIN(price), MAX(price) FROM products
+"""
+
+def _expert_prompt(question_text: str) -> str:
+    return _prompt_prefix(db_schema, fk_relationships_str) + f"\n-- New Task:\n### Question: {question_text}\n### SQL:"
+
+def _first_valid_query(question_text: str, potential_queries: list) -> str:
+    """
+    Returns the first generated candidate that passes validation, or an error message.
+    All candidates are validated together in one pipelined batch rather than one
+    EXPLAIN round-trip each; the earliest valid one still wins.
+    """
+    cleaned_options = [option.split('--')[0].strip() for option in potential_queries]
+    cleaned_options = [option for option in cleaned_options if option]
+    for cleaned_option, (is_valid, _) in zip(cleaned_options, validate_sql_queries(cleaned_options)):
+        if is_valid:
+            return cleaned_option
+    return f"Error: Could not generate a valid query for: {question_text}"
+
+def generate_expert_sql(question_text: str) -> str:
+    """
+    Generates an 'expert' answer for a lab question with the local model and
+    returns the first candidate that passes validation.
+    """
+    return _first_valid_query(question_text, generate_multiple_sql(_expert_prompt(question_text)))
+
+def generate_expert_sqls(questions: list) -> list:
+    """
+    Same as generate_expert_sql for several questions, with the candidates for all of
+    them generated in batched model calls instead of one call per question.
+    """
+    all_candidates = generate_multiple_sql_batch([_expert_prompt(question) for question in questions])
+    return [_first_valid_query(question, candidates) for question, candidates in zip(questions, all_candidates)]
+
+@st.cache_resource(show_spinner=False)
+def build_schema_graph(fk_relationships: tuple) -> graphviz.Digraph:
+    """
+    Builds the schema diagram from (table, column, foreign_table, foreign_column) tuples.
+    Cached so reruns (tab switches, widget changes) reuse the same Digraph.
+    """
+    dot = graphviz.Digraph(comment='Database Schema')
+    dot.attr('node', shape='box', style='rounded')
+    dot.attr('graph', rankdir='LR', splines='ortho')
+
+    tables = set()
+    for t1, c1, t2, c2 in fk_relationships:
+        tables.add(t1)
+        tables.add(t2)
+        dot.edge(t1, t2, label=f"{c1} → {c2}")
+
+    for table in tables:
+        dot.node(table, label=table)
+    return dot
+
+def metrics_frames(all_metrics: list):
+    """
+    Builds the Results tab's metrics DataFrame (and the summary without result sets) once
+    per new entry instead of on every rerun. all_metrics only ever grows, so its length
+    identifies its contents. The frames live in session_state because st.cache_data is
+    shared across sessions and would hash every stored result set on each rerun.
+    """
+    cached = st.session_state.get('metrics_frames')
+    if cached is None or cached[0] != len(all_metrics):
+        df = pd.DataFrame(all_metrics)
+        cached = (len(all_metrics), df, df.drop(columns=['results']))
+        st.session_state['metrics_frames'] = cached
+    return cached[1], cached[2]
+
+# Parsing is keyed on the file's bytes, so reruns and re-uploads of the same PDF skip it
+read_lab_sheet = st.cache_data(show_spinner=False)(extract_sql_from_pdf)
+
 # --- Main App ---
 st.title("🚀 SQL Validator and Automatic Grader")
 st.write("An AI-powered tool to generate, validate, and grade SQL queries.")
@@ -104,6 +205,9 @@ tab1, tab2, tab3, tab4, tab5 = st.tabs(["🗃️ Database Schema", "🤖 AI Quer
 with tab1:
     st.header("Database Schema Overview")
     st.info("This is the structure of the database that the AI uses to generate and evaluate queries.")
+    if st.button("Refresh schema", key="refresh_schema_button"):
+        clear_schema_cache()
+        st.rerun()
 
     col1, col2 = st.columns([1, 1])
 
@@ -114,25 +218,8 @@ with tab1:
     with col2:
         st.subheader("Foreign Key Relationships (JOINs)")
         if fk_relationships:
-            # Create a visual graph
-            dot = graphviz.Digraph(comment='Database Schema')
-            dot.attr('node', shape='box', style='rounded')
-            dot.attr('graph', rankdir='LR', splines='ortho')
-
-            tables = set()
-            for rel in fk_relationships:
-                # Example rel: "orders.customer_id can be joined with customers.customer_id"
-                parts = rel.split(' ')
-                t1, c1 = parts[0].split('.')
-                t2, c2 = parts[5].split('.')
-                tables.add(t1)
-                tables.add(t2)
-                dot.edge(t1, t2, label=f"{c1} → {c2}")
-            
-            for table in tables:
-                dot.node(table, label=table)
-
-            st.graphviz_chart(dot)
+            # Create a visual graph (built once per set of relationships)
+            st.graphviz_chart(build_schema_graph(tuple(fk_relationships)))
             
             # Also display as text
             st.code(fk_relationships_str, language="sql")
@@ -179,54 +266,34 @@ with tab2:
             st.warning("Please select or enter a question.")
         else:
             # --- 1. Build the full prompt ---
-            full_prompt = f"""-- You are a PostgreSQL expert. Given a database schema and a question, generate a correct PostgreSQL query.
--- Use table aliases for clarity. Pay close attention to the Foreign Key Relationships to construct JOINs.
-
--- Database Schema:
-{db_schema}
-
--- Foreign Key Relationships (How to JOIN tables):
-{fk_relationships_str}
-
--- Example 1 (Teaches a simple, single-table query):
-### Question: Show the name and country of all suppliers.
-### SQL: SELECT supplier_name, country FROM suppliers
-
--- Example 2 (Teaches JOIN and GROUP BY):
-### Question: How many products are in each category? Show the category name.
-### SQL: SELECT T2.category_name, count(T1.product_id) FROM products AS T1 JOIN categories AS T2 ON T1.category_id = T2.category_id GROUP BY T2.category_name
-
--- Example 3 (Teaches NOT IN Subquery):
-### Question: Find all customers who have not placed an order.
-### SQL: SELECT T1.first_name, T1.last_name FROM customers AS T1 WHERE T1.customer_id NOT IN (SELECT T2.customer_id FROM orders AS T2)
-
--- Example 4 (Teaches Subquery on a SINGLE TABLE):
-### Question: List all employees who earn more than the average salary.
-### SQL: SELECT T1.first_name, T1.salary FROM employees AS T1 WHERE T1.salary > (SELECT avg(T2.salary) FROM employees AS T2)
-
--- Example 5 (Teaches MIN/MAX Aggregate Functions):
-### Question: What is the lowest and highest price of a product?
-### SQL: SELECT MIN(price), MAX(price) FROM products
-
--- New Task:
-### Question: {question_input}
-### SQL:"""
+            full_prompt = _prompt_prefix(db_schema, fk_relationships_str) + f"\n-- New Task:\n### Question: {question_input}\n### SQL:"
             
             # --- 2. Generate and Validate ---
+            gemini_reviews = []
+            def start_gemini_review(query):
+                # Started before the query executes locally, so the two run at the same time
+                gemini_reviews.append(run_in_background(validate_and_score_sql_async(
+                    db_schema,
+                    fk_relationships_str,
+                    question_input,
+                    query
+                )))
+
             with st.spinner("Generating query with local model..."):
                 potential_queries = generate_multiple_sql(full_prompt)
+                cleaned_queries = [q.split('--')[0].strip() for q in potential_queries]
+                cleaned_queries = [q for q in cleaned_queries if q]
+                # Validate every candidate in one pipelined batch and run the first valid one
+                # on the same pooled connection
+                validations, execution = validate_sql_queries(cleaned_queries, execute_first_valid=True,
+                                                              before_execute=start_gemini_review)
+                invalid_queries = [q for q, (is_valid, _) in zip(cleaned_queries, validations) if not is_valid]
+            if execution is None:
                 local_query = "Error: Local model failed to generate a valid query."
-                valid_found = False
-                invalid_queries = []
-                for q in potential_queries:
-                    cleaned_q = q.split('--')[0].strip()
-                    if cleaned_q:
-                        is_valid, _ = validate_sql_query(cleaned_q)
-                        if is_valid and not valid_found:
-                            local_query = cleaned_q
-                            valid_found = True
-                        elif not is_valid:
-                            invalid_queries.append(cleaned_q)
+                start_gemini_review(local_query)
+            else:
+                local_query, results, error, exec_time = execution
+            gemini_review = gemini_reviews[0]
             # Show all invalid queries
             if invalid_queries:
                 st.subheader("Invalid Model-Generated Queries (not executed)")
@@ -237,16 +304,13 @@ with tab2:
                 st.error(local_query)
             else:
                 st.code(local_query, language="sql")
-                # --- Execute the generated query and show results ---
-                start_time = time.time()
-                results, error = execute_pg_query(local_query)
-                exec_time = time.time() - start_time
+                # --- Show the results of the query executed during validation ---
                 st.subheader("Query Results from Database")
                 if error:
                     st.error(error)
                 elif results is not None:
-                    if isinstance(results, list) and results:
-                        st.dataframe(pd.DataFrame(results))
+                    if isinstance(results, pd.DataFrame) and not results.empty:
+                        st.dataframe(results)
                         row_count = len(results)
                     elif isinstance(results, str):
                         st.success(results)
@@ -268,19 +332,14 @@ with tab2:
                         'rows_returned': row_count,
                         'valid': error is None,
                         'error_message': error if error else "",
-                        'results': results if isinstance(results, list) else str(results)
+                        'results': results if isinstance(results, pd.DataFrame) else str(results)
                     })
             
             # --- 3. Get Gemini API Review ---
             st.subheader("Google Gemini API Review")
             with st.spinner("Asking Google Gemini for a second opinion..."):
-                # Use the 'validate_and_score' function here
-                api_result = validate_and_score_sql_with_google_api(
-                    db_schema, 
-                    fk_relationships_str, 
-                    question_input, 
-                    local_query
-                )
+                # The review was started before execution; wait for whatever is left of it
+                api_result = gemini_review.result()
 
             if "error" in api_result:
                 st.error(f"API Error: {api_result['error']}")
@@ -309,8 +368,9 @@ with tab3:
     if uploaded_file is not None:
         if 'student_queries' not in st.session_state or st.session_state.get('processed_file') != uploaded_file.name:
             with st.spinner("Reading PDF and extracting student's SQL answers..."):
-                queries, pdf_error = extract_sql_from_pdf(uploaded_file)
+                queries, full_text, pdf_error = read_lab_sheet(uploaded_file.getvalue())
                 st.session_state.processed_file = uploaded_file.name
+                st.session_state.pdf_full_text = full_text or ""
                 if pdf_error:
                     st.error(pdf_error)
                     st.session_state.student_queries = []
@@ -325,14 +385,9 @@ with tab3:
         st.markdown("---")
         st.info("Let Gemini process and grade the entire PDF in one go. This works even if the PDF is a single block of text, as long as questions and answers are distinguishable.")
         if st.button("Grade the PDF", key="gemini_full_pdf_grade"):
-            import fitz  # PyMuPDF
-            with st.spinner("Extracting full text from PDF and sending to Gemini..."):
-                pdf_file = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-                full_text = ""
-                for page in pdf_file:
-                    full_text += page.get_text()
-                pdf_file.close()
-            
+            # Reuse the text extracted when the PDF was uploaded instead of parsing it again
+            full_text = st.session_state.pdf_full_text
+
             with st.spinner("Gemini is analyzing and grading the entire lab sheet..."):
                 # Placeholder for the new Gemini grading function
                 from google_api_validator import gemini_grade_full_lab_sheet
@@ -362,47 +417,7 @@ with tab3:
                 student_sql = st.session_state.student_queries[selected_index]
 
                 with st.spinner("Generating 'expert' answer and grading with Gemini..."):
-                    full_prompt = f"""-- You are a PostgreSQL expert. Given a database schema and a question, generate a correct PostgreSQL query.
--- Use table aliases for clarity. Pay close attention to the Foreign Key Relationships to construct JOINs.
-
--- Database Schema:
-{db_schema}
-
--- Foreign Key Relationships (How to JOIN tables):
-{fk_relationships_str}
-
--- Example 1 (Teaches a simple, single-table query):
-### Question: Show the name and country of all suppliers.
-### SQL: SELECT supplier_name, country FROM suppliers
-
--- Example 2 (Teaches JOIN and GROUP BY):
-### Question: How many products are in each category? Show the category name.
-### SQL: SELECT T2.category_name, count(T1.product_id) FROM products AS T1 JOIN categories AS T2 ON T1.category_id = T2.category_id GROUP BY T2.category_name
-
--- Example 3 (Teaches NOT IN Subquery):
-### Question: Find all customers who have not placed an order.
-### SQL: SELECT T1.first_name, T1.last_name FROM customers AS T1 WHERE T1.customer_id NOT IN (SELECT T2.customer_id FROM orders AS T2)
-
--- Example 4 (Teaches Subquery on a SINGLE TABLE):
-### Question: List all employees who earn more than the average salary.
-### SQL: SELECT T1.first_name, T1.salary FROM employees AS T1 WHERE T1.salary > (SELECT avg(T2.salary) FROM employees AS T2)
-
--- Example 5 (Teaches MIN/MAX Aggregate Functions):
-### Question: What is the lowest and highest price of a product?
-### SQL: SELECT MIN(price), MAX(price) FROM products
-
--- New Task:
-### Question: {question_text}
-### SQL:"""
-                    potential_queries = generate_multiple_sql(full_prompt)
-                    expert_sql = f"Error: Could not generate a valid query for: {question_text}"
-                    for option in potential_queries:
-                        cleaned_option = option.split('--')[0].strip()
-                        if cleaned_option:
-                            is_valid, _ = validate_sql_query(cleaned_option)
-                            if is_valid:
-                                expert_sql = cleaned_option
-                                break
+                    expert_sql = generate_expert_sql(question_text)
                     api_result = grade_student_sql_with_google_api(
                         db_schema, fk_relationships_str, question_text, expert_sql, student_sql
                     )
@@ -422,6 +437,35 @@ with tab3:
                     st.metric(label="Score", value=f"{score}/10")
                     st.info(f"**Feedback:** {feedback}")
 
+            # --- Grade every extracted answer; Gemini calls run concurrently ---
+            if st.button("Grade All Questions", key="grade_all_button"):
+                with st.spinner("Generating 'expert' answers for every question..."):
+                    question_pairs = list(zip(GROUND_TRUTH_QUESTIONS, st.session_state.student_queries))
+                    expert_sqls = generate_expert_sqls([question_text for question_text, _ in question_pairs])
+                    grading_items = [
+                        {
+                            "db_schema": db_schema,
+                            "fk_relationships": fk_relationships_str,
+                            "user_question": question_text,
+                            "expert_sql": expert_sql,
+                            "student_sql": student_sql,
+                        }
+                        for (question_text, student_sql), expert_sql in zip(question_pairs, expert_sqls)
+                    ]
+                with st.spinner("Grading all answers with Gemini..."):
+                    all_results = grade_many(grading_items)
+                for i, (item, api_result) in enumerate(zip(grading_items, all_results)):
+                    with st.expander(f"Question {i+1}: {item['user_question']}"):
+                        st.write("**Expert (AI-Generated) Query:**")
+                        st.code(item['expert_sql'], language="sql")
+                        st.write("**Student's Query:**")
+                        st.code(item['student_sql'], language="sql")
+                        if "error" in api_result:
+                            st.error(f"API Grading Error: {api_result['error']}")
+                        else:
+                            st.metric(label="Score", value=f"{api_result.get('score', 0)}/10")
+                            st.info(f"**Feedback:** {api_result.get('feedback', 'No feedback.')}")
+
 # ======================================================================
 # TAB 4: CHATBOT (CORRECTED VERSION)
 # ======================================================================
@@ -434,17 +478,7 @@ with tab4:
 
     if user_input:
         # Simple rule-based logic for the chatbot's response
-        cleaned_input = user_input.lower()
-        if "hello" in cleaned_input or "hi" in cleaned_input:
-            st.write("Hello! I am an automatic SQL grading assistant. Navigate the tabs to get started.")
-        elif "help" in cleaned_input:
-            st.write("Use the 'Database Schema' tab to view the data structure. Use the 'AI Query Generator' to test the AI. Use the 'Student Grader' to upload and grade a PDF.")
-        elif "schema" in cleaned_input:
-            st.write("Navigate to the 'Database Schema' tab to see all table structures and a visual diagram of how they are connected via foreign keys.")
-        elif "grade" in cleaned_input or "student" in cleaned_input:
-            st.write("Navigate to the 'Student Grader' tab, upload a student's lab sheet in PDF format, and then select questions one-by-one to grade them.")
-        else:
-            st.write("I'm sorry, I can only answer basic questions about how to use the app. Please try asking 'help'.")
+        st.write(app_help_response(user_input))
 
 with st.sidebar:
     st.header("Chatbot")
@@ -460,18 +494,17 @@ with tab5:
     st.header("📊 Results: Evaluation Metrics")
     st.info("This page shows evaluation metrics for all AI-generated queries in this session.")
     if 'all_metrics' in st.session_state and st.session_state['all_metrics']:
-        import pandas as pd
-        df = pd.DataFrame(st.session_state['all_metrics'])
-        st.dataframe(df.drop(columns=['results']))
+        df, summary_df = metrics_frames(st.session_state['all_metrics'])
+        st.dataframe(summary_df)
         st.subheader("Query Results for Each Execution")
-        for i, row in df.iterrows():
+        for i, row in enumerate(st.session_state['all_metrics']):
             with st.expander(f"Query {i+1}: {row['question']}"):
                 st.code(row['query'], language="sql")
                 if row['error_message']:
                     st.error(row['error_message'])
                 else:
-                    if isinstance(row['results'], list) and row['results']:
-                        st.dataframe(pd.DataFrame(row['results']))
+                    if isinstance(row['results'], pd.DataFrame) and not row['results'].empty:
+                        st.dataframe(row['results'])
                     else:
                         st.write(row['results'])
         st.subheader("Metrics Visualization")
@@ -1,6 +1,7 @@
 # Import necessary libraries for model loading and file/path handling
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, StoppingCriteria, StoppingCriteriaList
 import torch
+import functools
 import os
 from pathlib import Path    
 import sys # Import sys to exit gracefully
@@ -10,27 +11,99 @@ MODEL_ID = "google/flan-t5-large"  # Even more capable, but uses more RAM/disk
 
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 MODEL_PATH = os.path.join(PROJECT_ROOT, "local_flan_t5_large_model")  # New folder name
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from utils.logger import logger
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# bfloat16 halves the weight bandwidth of every decode step; unlike float16 it has
+# the same range as float32, so T5's large activations don't overflow
+MODEL_DTYPE = torch.bfloat16
+# USE_INT8=1 stores the Linear weights as int8 instead (a quarter of float32's bandwidth):
+# bitsandbytes on CUDA, PyTorch dynamic quantization on CPU
+USE_INT8 = os.environ.get("USE_INT8", "0").lower() in ("1", "true", "yes")
+MAX_INPUT_TOKENS = 2048
+# Prompts are a static prefix (instructions, schema, FKs, examples) followed by this marker and the question
+NEW_TASK_MARKER = "-- New Task:"
 
 tokenizer = None
 model = None
 
 if not os.path.isdir(MODEL_PATH):
-    print(f"Local model not found. Downloading '{MODEL_ID}' to '{MODEL_PATH}'...")
+    logger.info("Local model not found. Downloading '%s' to '%s'...", MODEL_ID, MODEL_PATH)
     tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
     model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_ID)
-    print("Saving model locally...")
+    logger.info("Saving model locally...")
     tokenizer.save_pretrained(MODEL_PATH)
     model.save_pretrained(MODEL_PATH)
-    print("✅ Model downloaded and saved successfully.")
+    logger.info("✅ Model downloaded and saved successfully.")
+
+# The saved copy keeps the full-precision weights; only the in-memory model is narrowed
+logger.info("Attempting to load model from local path: %s", MODEL_PATH)
+tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
+tokenizer.model_max_length = MAX_INPUT_TOKENS
+if USE_INT8 and DEVICE == "cuda":
+    from transformers import BitsAndBytesConfig  # Needs the bitsandbytes package
+    model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_PATH, quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                                                  device_map={"": 0}, low_cpu_mem_usage=True)
+    model = model.eval()
+    precision_label = "int8 (bitsandbytes)"
+elif USE_INT8:
+    # Dynamic quantization starts from float32 weights and quantizes activations on the fly
+    model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_PATH, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+    model = torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+    precision_label = "int8 (dynamic)"
 else:
-    print(f"Attempting to load model from local path: {MODEL_PATH}")
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
-    model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_PATH)
-    print("✅ Model and tokenizer loaded successfully from local folder.")
+    model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_PATH, torch_dtype=MODEL_DTYPE, low_cpu_mem_usage=True)
+    model = model.eval().to(DEVICE)
+    precision_label = str(MODEL_DTYPE)
+# The bitsandbytes int8 kernels don't trace, so the quantized model always runs eagerly
+if DEVICE == "cuda" and not USE_INT8:
+    try:
+        # Compile the forward pass that generate() runs for every decoding step. Dynamic shapes,
+        # because the prompt length and the KV cache grow from call to call.
+        model.forward = torch.compile(model.forward, dynamic=True)
+        torch._dynamo.config.suppress_errors = True  # Fall back to eager mode if a graph fails to compile
+    except Exception as e:
+        logger.warning("torch.compile is not available, running the model eagerly: %s", e)
+logger.info("✅ Model and tokenizer loaded successfully from local folder (%s, %s).", DEVICE, precision_label)
+
+class StopOnSemicolon(StoppingCriteria):
+    """
+    Stops each sequence as soon as it emits a token containing ';', since a SQL answer
+    is complete at that point; the remaining decoder steps would only be discarded.
+    """
+    def __init__(self, tokenizer):
+        semicolon_ids = [token_id for token, token_id in tokenizer.get_vocab().items() if ";" in token]
+        self.semicolon_ids = torch.tensor(semicolon_ids, dtype=torch.long, device=DEVICE)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.isin(input_ids[:, -1], self.semicolon_ids)
+
+STOPPING_CRITERIA = StoppingCriteriaList([StopOnSemicolon(tokenizer)])
+
+@functools.lru_cache(maxsize=8)
+def _encode_prefix(prompt_prefix: str) -> torch.Tensor:
+    """Tokenizes the static part of a prompt once; it only changes when the schema does."""
+    return tokenizer(prompt_prefix, add_special_tokens=False, return_tensors="pt").input_ids.to(DEVICE)
+
+def _encode(prompt: str):
+    """
+    Tokenizes a prompt, reusing the cached tokens of everything before "-- New Task:"
+    so only the question is encoded on each call.
+    Returns (input_ids, attention_mask) on the model's device.
+    """
+    prefix, marker, question = prompt.rpartition(NEW_TASK_MARKER)
+    question_ids = tokenizer(marker + question, return_tensors="pt").input_ids.to(DEVICE)
+    input_ids = torch.cat([_encode_prefix(prefix), question_ids], dim=1) if prefix else question_ids
+    # Keep the end of the prompt (the question and the end-of-sequence token) if it is too long
+    input_ids = input_ids[:, -MAX_INPUT_TOKENS:]
+    return input_ids, torch.ones_like(input_ids)
 
 # --- RELATIONSHIP-AWARE TRIFECTA MASTERCLASS PROMPT ---
 def _relationship_aware_prompt(nl_query: str, db_schema: str, fk_relationships: list) -> str:
-    fk_string = "\n".join([f"-- {rel}" for rel in fk_relationships if not rel.startswith("Error")])
+    fk_string = "\n".join([f"-- {t1}.{c1} can be joined with {t2}.{c2}" for t1, c1, t2, c2 in fk_relationships])
     return f"""
 -- You are a PostgreSQL expert. Given a database schema and a question, generate a correct PostgreSQL query.
 -- Use table aliases for clarity. Pay close attention to the Foreign Key Relationships to construct JOINs.
@@ -62,47 +135,87 @@ def generate_sql(nl_query: str, db_schema: str, fk_relationships: list):
     Generates a SQL query from a natural language question using a few-shot prompt.
     """
     prompt = _relationship_aware_prompt(nl_query, db_schema, fk_relationships)
-    print("--- Generating SQL with TRIFECTA MASTERCLASS prompt ---")
-    print(prompt)
-    inputs = tokenizer(prompt, return_tensors="pt", padding="longest", truncation=True, max_length=1024)
-    outputs = model.generate(inputs.input_ids, attention_mask=inputs.attention_mask, max_new_tokens=256)
+    # The logger formats lazily, so the few-KB prompt is only rendered when LOG_LEVEL=DEBUG
+    logger.debug("--- Generating SQL with TRIFECTA MASTERCLASS prompt ---\n%s", prompt)
+    input_ids, attention_mask = _encode(prompt)
+    with torch.inference_mode():
+        outputs = model.generate(input_ids, attention_mask=attention_mask, max_new_tokens=256,
+                                 stopping_criteria=STOPPING_CRITERIA, use_cache=True)
     generated_sql = tokenizer.decode(outputs[0], skip_special_tokens=True)
     if generated_sql.upper().startswith("SQL:"):
         generated_sql = generated_sql[4:].strip()
     cleaned_sql = generated_sql.strip()
-    print(f"--- Generated SQL ---")
-    print(cleaned_sql)
+    logger.debug("--- Generated SQL ---\n%s", cleaned_sql)
     return cleaned_sql
 
-def generate_multiple_sql(full_prompt: str, num_beams: int = 5, num_return_sequences: int = 3):
+def generate_multiple_sql(full_prompt: str, num_return_sequences: int = 3):
     """
     Generates multiple SQL queries from a single, fully-formed prompt string.
     This function is now a simple wrapper around the model.
+    The candidates are sampled in one pass instead of running a wide beam search.
     """
-    print("--- Generating MULTIPLE SQLs with the following prompt ---")
-    print(full_prompt) # This is great for debugging
-
-    inputs = tokenizer(
-        full_prompt,
-        return_tensors="pt",
-        padding="longest",
-        truncation=True,
-        max_length=2048  # Increased max_length for the large prompt
-    )
-    
-    outputs = model.generate(
-        inputs.input_ids,
-        attention_mask=inputs.attention_mask,
-        max_new_tokens=256,
-        num_beams=num_beams,
-        num_return_sequences=num_return_sequences,
-        early_stopping=True
-    )
+    logger.debug("--- Generating MULTIPLE SQLs with the following prompt ---\n%s", full_prompt)
+
+    input_ids, attention_mask = _encode(full_prompt)
+
+    with torch.inference_mode():
+        outputs = model.generate(
+            input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=192,  # SQL answers are short; generation stops early at EOS
+            do_sample=True,
+            top_p=0.9,
+            temperature=0.7,
+            num_return_sequences=num_return_sequences,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            stopping_criteria=STOPPING_CRITERIA,
+            use_cache=True
+        )
     
     generated_queries = tokenizer.batch_decode(outputs, skip_special_tokens=True)
     
     # Clean up the generated queries
     cleaned_queries = [sql.strip() for sql in generated_queries]
     
-    print(f"DEBUG: Generated multiple potential queries: {cleaned_queries}")
-    return cleaned_queries 
\ No newline at end of file
+    logger.debug("Generated multiple potential queries: %s", cleaned_queries)
+    return cleaned_queries 
+
+def generate_multiple_sql_batch(prompts: list, num_return_sequences: int = 3, batch_size: int = 8):
+    """
+    Same as generate_multiple_sql, for several prompts at once: each batch is one encoder
+    pass and one generate() call, so the weights are read once per step for every prompt.
+    Returns one list of candidate queries per prompt, in the same order as the prompts.
+    """
+    logger.debug("--- Generating MULTIPLE SQLs for %d prompts in batches of %d ---", len(prompts), batch_size)
+    results = []
+    for start in range(0, len(prompts), batch_size):
+        encoded = [_encode(prompt)[0][0] for prompt in prompts[start:start + batch_size]]
+        # Right-pad every prompt to the longest one and mask the padding out
+        input_ids = torch.nn.utils.rnn.pad_sequence(encoded, batch_first=True, padding_value=tokenizer.pad_token_id)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, ids in enumerate(encoded):
+            attention_mask[row, :len(ids)] = 1
+
+        with torch.inference_mode():
+            outputs = model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=192,
+                do_sample=True,
+                top_p=0.9,
+                temperature=0.7,
+                num_return_sequences=num_return_sequences,
+                eos_token_id=tokenizer.eos_token_id,
+                pad_token_id=tokenizer.pad_token_id,
+                stopping_criteria=STOPPING_CRITERIA,
+                use_cache=True
+            )
+
+        # generate() returns the sequences of each prompt next to each other
+        generated_queries = [sql.strip() for sql in tokenizer.batch_decode(outputs, skip_special_tokens=True)]
+        for i in range(0, len(generated_queries), num_return_sequences):
+            results.append(generated_queries[i:i + num_return_sequences])
+
+    logger.debug("Generated multiple potential queries: %s", results)
+    return results
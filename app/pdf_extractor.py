@@ -1,25 +1,77 @@
 import fitz  # PyMuPDF
 import re
 
-def extract_sql_from_pdf(pdf_file):
+# This regex looks for text between a number and a semicolon, which is a common pattern for SQL answers.
+# It's a simple approach and might need refinement based on the students' answer format.
+_SQL_RE = re.compile(r'\d+\.\s*(SELECT.*?);', re.DOTALL | re.IGNORECASE)
+
+# Optional: Hyperscan finds the "<number>. SELECT" headers in a single SIMD pass over the text.
+# It has no lazy quantifiers or capture groups, so the query after each header is cut at the
+# next ';' by a plain byte search instead (same result as _SQL_RE).
+try:
+    import hyperscan
+    _HEADER_DB = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+    _HEADER_DB.compile(
+        expressions=[rb'\d+\.\s*SELECT'],
+        flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SOM_LEFTMOST
+               | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP],
+    )
+except ImportError:
+    hyperscan = None
+
+def extract_text_from_pdf(pdf_bytes: bytes) -> str:
+    """
+    Returns the text of every page of a PDF, in reading order (top to bottom, left to right).
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        return "\n".join(page.get_text("text", sort=True) for page in doc)
+    finally:
+        doc.close()
+
+def _find_sql_queries(full_text: str) -> list:
+    """
+    Returns the raw queries matched by _SQL_RE, scanning with Hyperscan when it is installed.
+    """
+    if hyperscan is None:
+        return _SQL_RE.findall(full_text)
+
+    data = full_text.encode("utf-8")
+    headers = []
+    # A scratch space per call: the database is shared, but Streamlit may scan from several threads
+    _HEADER_DB.scan(data, match_event_handler=lambda _id, start, end, _flags, _ctx: headers.append((start, end)),
+                    scratch=hyperscan.Scratch(_HEADER_DB))
+
+    queries = []
+    resume_at = 0
+    for start, end in headers:
+        # Like re.findall, skip headers that fall inside the previous match
+        if start < resume_at:
+            continue
+        semicolon = data.find(b";", end)
+        if semicolon == -1:
+            break
+        # The keyword is the header's last six characters, but not always six bytes:
+        # caseless UCP matching also accepts folds such as the two-byte 'ſ' for 's'
+        keyword = data[start:end].decode("utf-8")[-len("SELECT"):]
+        queries.append(data[end - len(keyword.encode("utf-8")):semicolon].decode("utf-8"))
+        resume_at = semicolon + 1
+    return queries
+
+def extract_sql_from_pdf(pdf_bytes: bytes):
     """
     Extracts text from a PDF and uses regex to find potential SQL queries.
     Assumes queries are separated by question numbers like '1.', '2.', etc.
+    Returns (queries, full_text, error_message) so callers can reuse the text without re-parsing the PDF.
     """
     try:
-        doc = fitz.open(stream=pdf_file.read(), filetype="pdf")
-        full_text = ""
-        for page in doc:
-            full_text += page.get_text()
-        doc.close()
+        full_text = extract_text_from_pdf(pdf_bytes)
 
-        # This regex looks for text between a number and a semicolon, which is a common pattern for SQL answers.
-        # It's a simple approach and might need refinement based on the students' answer format.
-        queries = re.findall(r'\d+\.\s*(SELECT.*?);', full_text, re.DOTALL | re.IGNORECASE)
+        queries = _find_sql_queries(full_text)
         
         # Clean up the extracted queries
         cleaned_queries = [q.strip().replace('\n', ' ') for q in queries]
         
-        return cleaned_queries, None
+        return cleaned_queries, full_text, None
     except Exception as e:
-        return None, f"Failed to process PDF: {e}" 
\ No newline at end of file
+        return None, None, f"Failed to process PDF: {e}" 
\ No newline at end of file
@@ -1,14 +1,19 @@
+import re
+
+# Keywords for each intent, in priority order: a query mentioning both "show" and "delete" is a SELECT
+_INTENT_KEYWORDS = {
+    "SELECT": ["get", "show", "find", "select"],
+    "INSERT": ["add", "insert", "create"],
+    "UPDATE": ["update", "change", "modify"],
+    "DELETE": ["delete", "remove"],
+}
+_WORD_TO_INTENT = {word: intent for intent, words in _INTENT_KEYWORDS.items() for word in words}
+_INTENT_RANK = {intent: rank for rank, intent in enumerate(_INTENT_KEYWORDS)}
+# One alternation finds every keyword in a single scan of the query
+_INTENT_PATTERN = re.compile("|".join(_WORD_TO_INTENT))
+
 def classify_intent(nl_query):
     """Classify the intent of the query as SELECT/INSERT/UPDATE/DELETE."""
     # Placeholder: simple keyword-based intent classification
-    q = nl_query.lower()
-    if any(word in q for word in ["get", "show", "find", "select"]):
-        return "SELECT"
-    elif any(word in q for word in ["add", "insert", "create"]):
-        return "INSERT"
-    elif any(word in q for word in ["update", "change", "modify"]):
-        return "UPDATE"
-    elif any(word in q for word in ["delete", "remove"]):
-        return "DELETE"
-    else:
-        return "SELECT"  # Default fallback 
\ No newline at end of file
+    intents = {_WORD_TO_INTENT[match.group(0)] for match in _INTENT_PATTERN.finditer(nl_query.lower())}
+    return min(intents, key=_INTENT_RANK.__getitem__, default="SELECT")  # Default fallback
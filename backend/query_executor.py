@@ -1,5 +1,6 @@
-# Import the PostgreSQL adapter for Python
-import psycopg2
+# Import the PostgreSQL adapter for Python (psycopg 3, the same driver as app/database.py)
+import psycopg
+from psycopg.rows import dict_row
 # Import Streamlit for accessing secrets and displaying messages
 import streamlit as st
 
@@ -7,7 +8,7 @@ def get_db_connection():
     """Establishes and returns a database connection."""
     try:
         db_config = st.secrets.postgres
-        return psycopg2.connect(
+        return psycopg.connect(
             host=db_config.host,
             port=db_config.port,
             user=db_config.user,
@@ -55,7 +56,7 @@ def get_database_schema_string():
         print(schema_string)
         print("----------------------------------------------------------------")
         return schema_string.strip()
-    except psycopg2.Error as db_err:
+    except psycopg.Error as db_err:
         print(f"Database error while fetching schema: {db_err}")
         return f"Error: Database error while fetching schema: {db_err}"
     finally:
@@ -77,7 +78,7 @@ def validate_sql_query(sql_query: str):
         cursor.execute(f"EXPLAIN {sql_query}")
         cursor.close()
         return True, "Query syntax is valid."
-    except psycopg2.Error as db_err:
+    except psycopg.Error as db_err:
         error_message = f"Invalid Query: {str(db_err).splitlines()[0]}"
         return False, error_message
     finally:
@@ -94,21 +95,19 @@ def execute_pg_query(sql_query: str):
     conn = None
     try:
         conn = get_db_connection()
-        cursor = conn.cursor()
+        # dict_row makes the cursor return each row as a {column: value} dict
+        cursor = conn.cursor(row_factory=dict_row)
         cursor.execute(sql_query)
-        results = None
-        if sql_query.strip().upper().startswith("SELECT"):
-            if cursor.description:
-                colnames = [desc[0] for desc in cursor.description]
-                results = [dict(zip(colnames, row)) for row in cursor.fetchall()]
-            else:
-                results = []
+        # Postgres reports whether the statement returned a result set (SELECT, WITH,
+        # SHOW, ... RETURNING), so there is no need to inspect the query text
+        if cursor.description is not None:
+            results = cursor.fetchall()
         else:
-            conn.commit()
             results = f"Query executed successfully. Rows affected: {cursor.rowcount}"
+        conn.commit()
         cursor.close()
         return results, None
-    except psycopg2.Error as db_err:
+    except psycopg.Error as db_err:
         error_message = f"Database Execution Error: {str(db_err).splitlines()[0]}"
         return None, error_message
     finally:
@@ -128,7 +127,7 @@ def list_tables():
             'password': st.secrets.postgres.password,
             'dbname': st.secrets.postgres.dbname
         }
-        conn = psycopg2.connect(**db_config)
+        conn = psycopg.connect(**db_config)
         cursor = conn.cursor()
         cursor.execute("""
             SELECT table_name
@@ -179,7 +178,7 @@ def get_foreign_key_relationships():
             relationships.append(f"{table_name}.{column_name} can be joined with {foreign_table_name}.{foreign_column_name}")
         cursor.close()
         return relationships
-    except psycopg2.Error as db_err:
+    except psycopg.Error as db_err:
         return [f"DB Error fetching FKs: {db_err}"]
     finally:
         if conn:
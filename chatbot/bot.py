@@ -1,13 +1,49 @@
+import re
+
+# --- Rule tables: (keywords, reply), in priority order ---
+_CHAT_RULES = [
+    (("hello", "hi"), "Hello! I can help you convert natural language to SQL. Ask me anything!"),
+    (("help",), "Type your question in plain English, and I'll generate the SQL for you."),
+    (("example",), "For example: 'Get all employees in Engineering department'."),
+    (("explain",), "I generate SQL queries using a language model trained on text-to-SQL datasets."),
+]
+_CHAT_DEFAULT = "I'm here to help! Ask me about SQL queries or how to use this app."
+
+_APP_HELP_RULES = [
+    (("hello", "hi"), "Hello! I am an automatic SQL grading assistant. Navigate the tabs to get started."),
+    (("help",), "Use the 'Database Schema' tab to view the data structure. Use the 'AI Query Generator' to test the AI. Use the 'Student Grader' to upload and grade a PDF."),
+    (("schema",), "Navigate to the 'Database Schema' tab to see all table structures and a visual diagram of how they are connected via foreign keys."),
+    (("grade", "student"), "Navigate to the 'Student Grader' tab, upload a student's lab sheet in PDF format, and then select questions one-by-one to grade them."),
+]
+_APP_HELP_DEFAULT = "I'm sorry, I can only answer basic questions about how to use the app. Please try asking 'help'."
+
+
+def _compile_rules(rules):
+    """
+    Builds one alternation over every keyword of a rule table, so the input is scanned once.
+    Keywords must start a word ("hi" matches "hi there", not "this") but may be
+    extended ("grade" still matches "grading").
+    Returns (pattern, keyword -> rule index).
+    """
+    keyword_rule = {keyword: i for i, (keywords, _) in enumerate(rules) for keyword in keywords}
+    return re.compile(r"\b(?:" + "|".join(keyword_rule) + ")"), keyword_rule
+
+_CHAT_MATCHER = _compile_rules(_CHAT_RULES)
+_APP_HELP_MATCHER = _compile_rules(_APP_HELP_RULES)
+
+
+def _respond(user_input, rules, matcher, default):
+    """Returns the reply of the highest-priority rule with a keyword in the input."""
+    pattern, keyword_rule = matcher
+    matched_rules = [keyword_rule[match.group(0)] for match in pattern.finditer(user_input.lower())]
+    return rules[min(matched_rules)][1] if matched_rules else default
+
+
 def chatbot_response(user_input):
     """Basic rule-based chatbot for guidance and explanations."""
-    user_input = user_input.lower()
-    if "hello" in user_input or "hi" in user_input:
-        return "Hello! I can help you convert natural language to SQL. Ask me anything!"
-    elif "help" in user_input:
-        return "Type your question in plain English, and I'll generate the SQL for you."
-    elif "example" in user_input:
-        return "For example: 'Get all employees in Engineering department'."
-    elif "explain" in user_input:
-        return "I generate SQL queries using a language model trained on text-to-SQL datasets."
-    else:
-        return "I'm here to help! Ask me about SQL queries or how to use this app." 
\ No newline at end of file
+    return _respond(user_input, _CHAT_RULES, _CHAT_MATCHER, _CHAT_DEFAULT)
+
+
+def app_help_response(user_input):
+    """Rule-based answers to questions about how to use the app's tabs."""
+    return _respond(user_input, _APP_HELP_RULES, _APP_HELP_MATCHER, _APP_HELP_DEFAULT)
@@ -1,15 +1,21 @@
 # nlp_preprocessing/dynamic_synonym_generator.py
+import functools
 import re
+from types import MappingProxyType
 
-def _generate_synonym_map(schema_string: str) -> dict:
+# Words that are likely column names inside the schema string:
+# words before an opening parenthesis or at the start of / inside a column list
+_COLUMN_RE = re.compile(r'(\w+)\s*\(|\[\s*(\w+)|,\s*(\w+)')
+
+@functools.lru_cache(maxsize=8)
+def _generate_synonym_map(schema_string: str) -> MappingProxyType:
     """
     Automatically generates a synonym map from a database schema string.
     It finds all column names with underscores and creates synonyms.
+    The map is built once per schema and returned read-only, since it is shared between callers.
     """
     synonym_map = {}
-    # Regex to find all words that are likely column names inside the schema string.
-    # It looks for words before an opening parenthesis or at the start of the column list.
-    all_columns = re.findall(r'(\w+)\s*\(|\[\s*(\w+)|,\s*(\w+)', schema_string)
+    all_columns = _COLUMN_RE.findall(schema_string)
     # The regex returns tuples of capture groups, so we flatten the list and get unique names
     flat_columns = [item for sublist in all_columns for item in sublist if item]
     unique_columns = sorted(list(set(flat_columns)))
@@ -24,16 +30,30 @@ def _generate_synonym_map(schema_string: str) -> dict:
             if synonym_with_space:
                 synonym_map[synonym_with_space] = column
     print(f"Dynamically generated synonym map: {synonym_map}")
-    return synonym_map
+    return MappingProxyType(synonym_map)
 
-def replace_synonyms_dynamically(nl_query: str, schema_string: str) -> str:
+@functools.lru_cache(maxsize=16)
+def _synonym_pattern(schema_string: str):
     """
-    Replaces known synonyms in the user's query with the correct database column names.
+    Builds one alternation regex over every synonym of the schema, longest first so the
+    longest synonym wins at each position, plus a lowercase lookup for the matches.
+    Returns (pattern, lookup), or (None, {}) if the schema has no synonyms.
     """
     synonym_map = _generate_synonym_map(schema_string)
+    if not synonym_map:
+        return None, {}
     sorted_synonyms = sorted(synonym_map.keys(), key=len, reverse=True)
-    for synonym in sorted_synonyms:
-        db_column = synonym_map[synonym]
-        nl_query = re.sub(r'\b' + re.escape(synonym) + r'\b', db_column, nl_query, flags=re.IGNORECASE)
+    pattern = re.compile(r'\b(?:' + '|'.join(map(re.escape, sorted_synonyms)) + r')\b', re.IGNORECASE)
+    lookup = {synonym.lower(): db_column for synonym, db_column in synonym_map.items()}
+    return pattern, lookup
+
+def replace_synonyms_dynamically(nl_query: str, schema_string: str) -> str:
+    """
+    Replaces known synonyms in the user's query with the correct database column names.
+    All synonyms are replaced in a single pass over the query.
+    """
+    pattern, lookup = _synonym_pattern(schema_string)
+    if pattern:
+        nl_query = pattern.sub(lambda match: lookup[match.group(0).lower()], nl_query)
     print(f"Query after dynamic synonym replacement: {nl_query}")
-    return nl_query 
\ No newline at end of file
+    return nl_query
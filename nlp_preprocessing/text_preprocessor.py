@@ -1,9 +1,17 @@
 import spacy
 
-nlp = spacy.load("en_core_web_sm")
+# Only lemmas and the stopword/punctuation flags are used: the lemmatizer needs the tagger and
+# attribute_ruler, so the dependency parser and NER are never run
+nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
+
+def _clean(doc):
+    tokens = [token.lemma_.lower() for token in doc if not token.is_stop and not token.is_punct]
+    return " ".join(tokens)
 
 def preprocess_text(text):
     """Clean and tokenize user input using spaCy."""
-    doc = nlp(text)
-    tokens = [token.lemma_.lower() for token in doc if not token.is_stop and not token.is_punct]
-    return " ".join(tokens) 
\ No newline at end of file
+    return _clean(nlp(text))
+
+def preprocess_texts(texts):
+    """Same as preprocess_text for many inputs, streamed through spaCy in batches."""
+    return [_clean(doc) for doc in nlp.pipe(texts, batch_size=64)]
@@ -0,0 +1,68 @@
+import os
+import sys
+
+# The app's modules import each other by bare name, so put app/ on the path first
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app"))
+
+import pandas as pd
+
+from database import _check_explainable, _unique_column_names
+
+# Each of these smuggles a second statement past a naive ';'-inside-a-literal check
+SMUGGLED_QUERIES = [
+    "SELECT 1; DROP TABLE t",
+    "SELECT E'\\''; DROP TABLE t; SELECT '1'",
+    "SELECT 'a\\'; DROP TABLE t; SELECT '1'",
+    "SELECT $$'$$; DROP TABLE t; SELECT $$'$$",
+    "SELECT $tag$'$tag$; DROP TABLE t; SELECT $tag$'$tag$",
+    "SELECT 1 /* ' */; DROP TABLE t; /* ' */",
+    "SELECT 1 -- '\n; DROP TABLE t; --'",
+    "SELECT \"'\"; DROP TABLE t; SELECT \"'\"",
+    "SELECT 'unterminated; DROP TABLE t",
+]
+
+ACCEPTED_QUERIES = [
+    "SELECT 1",
+    "SELECT 1;",
+    "select 'a;b' AS x",
+    "SELECT 'it''s; fine', \"odd;name\" FROM t",
+    "SELECT first_name FROM customers -- only a comment; nothing else",
+    "  WITH x AS (SELECT 1) SELECT * FROM x",
+]
+
+
+def test_rejects_smuggled_statements():
+    for query in SMUGGLED_QUERIES:
+        checked, error = _check_explainable(query)
+        assert checked is None and error, query
+
+
+def test_accepts_single_statements():
+    for query in ACCEPTED_QUERIES:
+        checked, error = _check_explainable(query)
+        assert error is None, (query, error)
+        assert checked == query.strip().rstrip(";")
+
+
+def test_rejects_non_query_statements():
+    for query in ["", "   ", None, "DROP TABLE t", "COPY t TO '/tmp/x'"]:
+        checked, error = _check_explainable(query)
+        assert checked is None and error, query
+
+
+def test_repeated_column_names_are_suffixed():
+    # e.g. SELECT T1.name, T2.name, T1.category_id, T2.category_id ... from a join
+    names = ["name", "name", "category_id", "name_1", "category_id", "name"]
+    unique_names = _unique_column_names(names)
+    assert unique_names == ["name", "name_2", "category_id", "name_1", "category_id_1", "name_3"]
+    frame = pd.DataFrame.from_records([tuple(range(len(names)))], columns=unique_names)
+    assert frame.columns.is_unique
+    assert _unique_column_names(["a", "b"]) == ["a", "b"]
+
+
+if __name__ == "__main__":
+    test_rejects_smuggled_statements()
+    test_accepts_single_statements()
+    test_rejects_non_query_statements()
+    test_repeated_column_names_are_suffixed()
+    print("All database checks passed.")
@@ -1,7 +1,11 @@
 import logging
+import os
 
 logger = logging.getLogger("text2sql")
-logger.setLevel(logging.DEBUG)
+# INFO by default; LOG_LEVEL=DEBUG also logs the full prompts and generated candidates.
+# An unknown level name falls back to INFO instead of failing at import.
+_level_name = os.environ.get("LOG_LEVEL", "INFO").upper()
+logger.setLevel(logging.getLevelNamesMapping().get(_level_name, logging.INFO))
 
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)